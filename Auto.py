@@ -1,8 +1,22 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pa_csv
 from io import BytesIO
 import zipfile
+import xlsxwriter
 import re
+import hashlib
+import datetime
+from functools import lru_cache
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+from python_calamine import CalamineWorkbook
+from pandas._libs.parsers import STR_NA_VALUES
+
+# Arrow-backed strings for all text columns
+pd.options.future.infer_string = True
 
 st.set_page_config(page_title="GST & Books Auto-Fill Tool", layout="wide")
 st.title("📥 Auto-Fill GST & Books Templates (Merged Sheets)")
@@ -49,80 +63,206 @@ gst_column_map = {
     "IRN NUMBER": ["IRN"]
 }
 
+EXCEL_EPOCH = pd.Timestamp("1899-12-30")
+EXCEL_MAX_SERIAL = (pd.Timestamp.max.to_pydatetime(warn=False) - EXCEL_EPOCH.to_pydatetime()).days
+WRITE_BLOCK_ROWS = 10_000
+
 # ---------------------------
 # Helper Functions
 # ---------------------------
+_WS_RE = re.compile(r'\s+')
+_NW_RE = re.compile(r'\W')
+
+@lru_cache(maxsize=8192)
 def clean_column_name(col):
     """Clean column names for consistent mapping."""
     if not isinstance(col, str):
         col = str(col)
     col = col.strip()
-    col = re.sub(r'\s+', ' ', col)   # replace multiple spaces with single space
-    col = re.sub(r'\W', '', col)     # remove non-alphanumeric characters
+    col = _WS_RE.sub(' ', col)   # replace multiple spaces with single space
+    col = _NW_RE.sub('', col)   # remove non-alphanumeric characters
     return col.upper()
 
-def map_columns(df, column_map):
-    """Map any dataframe to template columns, robust to messy headers."""
-    mapped_df = pd.DataFrame(columns=template_columns)
+# Candidate headers cleaned once at startup instead of per sheet
+books_column_map_clean = {tpl: [clean_column_name(c) for c in cands] for tpl, cands in books_column_map.items()}
+gst_column_map_clean = {tpl: [clean_column_name(c) for c in cands] for tpl, cands in gst_column_map.items()}
 
-    # Clean dataframe columns
-    df_cols_clean = {clean_column_name(col): col for col in df.columns}
+def resolve_columns(headers, column_map_clean):
+    """Find the position of the source column feeding each template column."""
+    # First occurrence wins for repeated headers, as pandas' X / X.1 renaming did
+    header_pos = {}
+    for i, col in enumerate(headers):
+        header_pos.setdefault(clean_column_name(col), i)
 
-    for template_col, possible_cols in column_map.items():
-        mapped = False
-        for col in possible_cols:
-            col_clean = clean_column_name(col)
-            if col_clean in df_cols_clean:
-                mapped_df[template_col] = df[df_cols_clean[col_clean]]
-                mapped = True
+    positions = {}
+    for template_col, possible_cols in column_map_clean.items():
+        for col_clean in possible_cols:
+            if col_clean in header_pos:
+                positions[template_col] = header_pos[col_clean]
                 break
-        if not mapped:
-            mapped_df[template_col] = ""
-    return mapped_df
+    return positions
+
+def empty_template_df():
+    """Zero-row template dataframe with Arrow-backed text columns (keeps concat dtypes intact)."""
+    return pd.DataFrame({col: pd.array([], dtype="string[pyarrow]") for col in template_columns})
+
+def map_columns(df, column_map_clean):
+    """Map any dataframe to template columns, robust to messy headers.
+
+    `column_map_clean` maps template columns to already-cleaned candidate headers.
+    """
+    # Resolve source columns by position once; no label lookups per template column.
+    # Positions also keep repeated labels (kept as-is by pyarrow CSV) unambiguous: the first one is used.
+    positions = resolve_columns(df.columns, column_map_clean)
+
+    # Sheets with no recognised headers contribute no rows
+    if not positions:
+        return empty_template_df()
+
+    data = {template_col: df.iloc[:, pos].array for template_col, pos in positions.items()}
+    for template_col in template_columns:
+        if template_col not in data:
+            data[template_col] = pd.array([""] * len(df), dtype="string[pyarrow]")
+    return pd.DataFrame(data, columns=template_columns, copy=False)
 
 def preprocess_df(df):
     """Robust preprocessing for numeric and date columns."""
 
     # ---- Numeric columns ----
-    numeric_cols = ["INVOICE VALUE","TAXABLE VALUE","INTEGRATED TAX","CENTRAL TAX","STATE/UT TAX"]
-    for col in numeric_cols:
-        if col in df.columns:
-            df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0)
+    numeric_cols = [col for col in ["INVOICE VALUE","TAXABLE VALUE","INTEGRATED TAX","CENTRAL TAX","STATE/UT TAX"] if col in df.columns]
+    if numeric_cols:
+        # Convert all amount columns together and assign them in a single block update
+        df[numeric_cols] = df[numeric_cols].apply(pd.to_numeric, errors='coerce').fillna(0).astype("float64")
 
     # ---- Date column ----
     if "INVOICE DATE" in df.columns:
-        def normalize_date(val):
-            if pd.isna(val) or str(val).strip() == "":
-                return ""
-            val_str = str(val).strip().split(" ")[0]
-
-            # Case 1: Excel serial numbers
-            if str(val_str).replace(".", "").isdigit():
-                try:
-                    return (pd.to_datetime("1899-12-30") 
-                            + pd.to_timedelta(int(float(val_str)), unit="D")
-                           ).strftime("%d-%m-%Y")
-                except:
-                    pass
-
-            # Case 2: Try common formats
-            for fmt in ("%d-%m-%Y", "%d/%m/%Y", "%d-%b-%Y", "%d-%b-%y", "%Y-%m-%d", "%Y/%m/%d"):
-                try:
-                    dt = pd.to_datetime(val_str, format=fmt, errors="raise", dayfirst=True)
-                    return dt.strftime("%d-%m-%Y")
-                except:
-                    continue
-
-            # Case 3: Fallback to pandas auto parse
-            try:
-                return pd.to_datetime(val_str, errors="coerce", dayfirst=True).strftime("%d-%m-%Y")
-            except:
-                return ""
-
-        df["INVOICE DATE"] = df["INVOICE DATE"].apply(normalize_date)
+        # First token of the trimmed value; one regex pass instead of materialising split lists
+        s = df["INVOICE DATE"].astype("string[pyarrow]").str.strip().str.replace(r"(?s) .*", "", regex=True)
+
+        # Case 1: Excel serial numbers (out-of-range serials fall through to the formats below)
+        mask_num = s.str.fullmatch(r"\d+(\.\d+)?").fillna(False)
+        serial_days = s.where(mask_num).astype(float).floordiv(1)
+        serial_days = serial_days.where(serial_days <= EXCEL_MAX_SERIAL)
+        serial_dates = EXCEL_EPOCH + pd.to_timedelta(serial_days, unit="D")
+
+        # Case 2: Everything else in a single mixed-format parse. UTC offsets / "Z" after a time are
+        # dropped first (the local date is kept); mixed offsets or aware+naive values would raise.
+        s = s.str.replace(r"(\d{2}:\d{2}(?::\d{2}(?:\.\d+)?)?)(?:Z|[+-]\d{2}:?\d{2})$", r"\1", regex=True)
+        parsed = pd.to_datetime(s.where(serial_dates.isna()), format="mixed", dayfirst=True, errors="coerce")
+
+        df["INVOICE DATE"] = serial_dates.combine_first(parsed).dt.strftime("%d-%m-%Y").fillna("")
 
     return df
 
+def cell_to_str(value):
+    """Convert a calamine cell to the text pandas would have read for it."""
+    # Blank cells and pandas' default NA tokens ("NA", "N/A", "null", "#N/A", ...) are missing
+    if isinstance(value, str) and value in STR_NA_VALUES:
+        return None
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    if isinstance(value, datetime.date):
+        return str(pd.Timestamp(value))
+    return str(value)
+
+def get_file_key(file_bytes):
+    """Hash an upload once per rerun; cached functions key on this instead of rehashing the bytes."""
+    return hashlib.md5(file_bytes).hexdigest()
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def get_sheet_names(file_key, _file_bytes):
+    """List sheet names without parsing any sheet data."""
+    return CalamineWorkbook.from_filelike(BytesIO(_file_bytes)).sheet_names
+
+def read_sheet(file_bytes, sheet, header_row, column_map_clean):
+    """Stream a sheet into template columns, keeping only the mapped source columns."""
+    # Each call opens its own workbook: sheet reads on a shared one cannot overlap across threads
+    rows = CalamineWorkbook.from_filelike(BytesIO(file_bytes)).get_sheet_by_name(sheet).iter_rows()
+    headers = next(islice(rows, header_row-1, None), None)
+    positions = resolve_columns(headers, column_map_clean) if headers is not None else {}
+
+    # Sheets with no recognised headers contribute no rows
+    if not positions:
+        return empty_template_df()
+
+    idx = list(positions.values())
+    values = [[cell_to_str(row[i]) for i in idx] for row in rows]
+    values = np.array(values, dtype=object).reshape(len(values), len(idx))
+
+    data = {template_col: pd.array(values[:, j], dtype="string[pyarrow]") for j, template_col in enumerate(positions)}
+    for template_col in template_columns:
+        if template_col not in data:
+            data[template_col] = pd.array([""] * len(values), dtype="string[pyarrow]")
+    return pd.DataFrame(data, columns=template_columns, copy=False)
+
+def read_csv_sheet(file_bytes, header_row, column_map_clean):
+    """Read a CSV upload with the multithreaded pyarrow parser and map it to template columns."""
+    read_options = pa_csv.ReadOptions(skip_rows=header_row-1)
+    skipped_rows = []
+    try:
+        # Header names come from the first block only, so every column can be read as text
+        column_names = pa_csv.open_csv(BytesIO(file_bytes), read_options=read_options).schema.names
+        convert_options = pa_csv.ConvertOptions(column_types={col: pa.string() for col in column_names}, strings_can_be_null=True)
+
+        table = pa_csv.read_csv(BytesIO(file_bytes), read_options=read_options, convert_options=convert_options)
+        df = table.to_pandas(types_mapper={pa.string(): pd.StringDtype("pyarrow")}.get)
+    except pa.ArrowInvalid:
+        # Ragged rows, non-UTF-8 text or a header row past the end of the file: fall back to pandas,
+        # which pads short rows; rows with too many fields are skipped and reported
+        try:
+            df = pd.read_csv(BytesIO(file_bytes), skiprows=header_row-1, dtype="string[pyarrow]", encoding_errors="replace",
+                             engine="python", on_bad_lines=skipped_rows.append)
+        except pd.errors.EmptyDataError:
+            return empty_template_df()
+        except pd.errors.ParserError as e:
+            mapped_df = empty_template_df()
+            mapped_df.attrs["read_error"] = str(e)
+            return mapped_df
+
+    mapped_df = map_columns(df, column_map_clean)
+    mapped_df.attrs["skipped_rows"] = len(skipped_rows)
+    return mapped_df
+
+@st.cache_data(show_spinner=False, max_entries=256)
+def process_sheet(file_key, _file_bytes, sheet, header_row, column_map_clean, is_csv=False):
+    """Read, map and preprocess a single sheet, cached so sheet selection changes are instant."""
+    if is_csv:
+        return preprocess_df(read_csv_sheet(_file_bytes, header_row, column_map_clean))
+    return preprocess_df(read_sheet(_file_bytes, sheet, header_row, column_map_clean))
+
+def process_sheets(file_key, file_bytes, sheets, header_row, column_map_clean, is_csv=False):
+    """Process the selected sheets in parallel and merge them into one template dataframe."""
+    if not sheets:
+        return preprocess_df(empty_template_df())
+
+    with ThreadPoolExecutor(max_workers=min(8, len(sheets))) as executor:
+        frames = list(executor.map(lambda sheet: process_sheet(file_key, file_bytes, sheet, header_row, column_map_clean, is_csv), sheets))
+
+    # Problems found while reading are reported here, on the script thread
+    for sheet, frame in zip(sheets, frames):
+        if frame.attrs.get("read_error"):
+            st.warning(f"Could not read '{sheet}': {frame.attrs['read_error']}")
+        if frame.attrs.get("skipped_rows"):
+            st.warning(f"Skipped {frame.attrs['skipped_rows']} row(s) in '{sheet}' with more fields than the header.")
+
+    # Concat once (avoids quadratic copying)
+    return pd.concat(frames, ignore_index=True, copy=False)
+
+def write_template_xlsx(output, df, sheet_name):
+    """Stream a template dataframe to XLSX row by row (constant memory)."""
+    workbook = xlsxwriter.Workbook(output, {"constant_memory": True, "strings_to_numbers": False, "strings_to_urls": False, "nan_inf_to_errors": True})
+    worksheet = workbook.add_worksheet(sheet_name)
+    header_format = workbook.add_format({"bold": True, "border": 1, "align": "center", "valign": "top"})
+    worksheet.write_row(0, 0, df.columns, header_format)
+
+    # Convert in blocks so memory stays bounded; missing values become empty cells
+    for start in range(0, len(df), WRITE_BLOCK_ROWS):
+        block = df.iloc[start:start + WRITE_BLOCK_ROWS]
+        block = block.astype(object).where(block.notna(), None)
+        for i, row in enumerate(block.itertuples(index=False, name=None), start + 1):
+            worksheet.write_row(i, 0, row)
+    workbook.close()
+
 # ---------------------------
 # File Upload
 # ---------------------------
@@ -140,47 +280,38 @@ if books_file or gst_file:
 
     # ---------------- Books Processing ----------------
     if books_file:
-        books_xl = pd.ExcelFile(books_file)
-        books_sheets = books_xl.sheet_names
+        books_file_bytes = books_file.getvalue()
+        books_file_key = get_file_key(books_file_bytes)
+        books_is_csv = books_file.name.lower().endswith(".csv")
+        # A CSV file is treated as a single sheet named after the file
+        books_sheets = [books_file.name] if books_is_csv else get_sheet_names(books_file_key, books_file_bytes)
         selected_books_sheets = st.multiselect("Select Books Sheets to Auto-Fill", books_sheets, default=books_sheets)
 
-        combined_books_df = pd.DataFrame(columns=template_columns)
-        for sheet in selected_books_sheets:
-            df = pd.read_excel(books_file, sheet_name=sheet, header=books_header_row-1, dtype=str)
-            mapped_df = map_columns(df, books_column_map)
-            mapped_df = preprocess_df(mapped_df)
-            combined_books_df = pd.concat([combined_books_df, mapped_df], ignore_index=True)
+        combined_books_df = process_sheets(books_file_key, books_file_bytes, selected_books_sheets, books_header_row, books_column_map_clean, books_is_csv)
 
     # ---------------- GST Processing ----------------
     if gst_file:
-        gst_xl = pd.ExcelFile(gst_file)
-        gst_sheets = gst_xl.sheet_names
+        gst_file_bytes = gst_file.getvalue()
+        gst_file_key = get_file_key(gst_file_bytes)
+        gst_is_csv = gst_file.name.lower().endswith(".csv")
+        # A CSV file is treated as a single sheet named after the file
+        gst_sheets = [gst_file.name] if gst_is_csv else get_sheet_names(gst_file_key, gst_file_bytes)
         selected_gst_sheets = st.multiselect("Select GST Sheets to Auto-Fill", gst_sheets, default=gst_sheets)
 
-        combined_gst_df = pd.DataFrame(columns=template_columns)
-        for sheet in selected_gst_sheets:
-            df = pd.read_excel(gst_file, sheet_name=sheet, header=gst_header_row-1, dtype=str)
-            mapped_df = map_columns(df, gst_column_map)
-            mapped_df = preprocess_df(mapped_df)
-            combined_gst_df = pd.concat([combined_gst_df, mapped_df], ignore_index=True)
+        combined_gst_df = process_sheets(gst_file_key, gst_file_bytes, selected_gst_sheets, gst_header_row, gst_column_map_clean, gst_is_csv)
 
     # ---------------- Create ZIP ----------------
     if (books_file and not combined_books_df.empty) or (gst_file and not combined_gst_df.empty):
         zip_buffer = BytesIO()
-        with zipfile.ZipFile(zip_buffer, "w") as zip_file:
+        # Templates are written straight into their ZIP entries, with no intermediate XLSX buffers
+        with zipfile.ZipFile(zip_buffer, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=1) as zip_file:
             if books_file and not combined_books_df.empty:
-                books_bytes = BytesIO()
-                with pd.ExcelWriter(books_bytes, engine="openpyxl") as writer:
-                    combined_books_df.to_excel(writer, index=False, sheet_name="Books_Template")
-                books_bytes.seek(0)
-                zip_file.writestr("Books_AutoFilled_Template.xlsx", books_bytes.getvalue())
+                with zip_file.open("Books_AutoFilled_Template.xlsx", "w") as books_entry:
+                    write_template_xlsx(books_entry, combined_books_df, "Books_Template")
 
             if gst_file and not combined_gst_df.empty:
-                gst_bytes = BytesIO()
-                with pd.ExcelWriter(gst_bytes, engine="openpyxl") as writer:
-                    combined_gst_df.to_excel(writer, index=False, sheet_name="GST_Combined_Template")
-                gst_bytes.seek(0)
-                zip_file.writestr("GST_AutoFilled_Combined_Template.xlsx", gst_bytes.getvalue())
+                with zip_file.open("GST_AutoFilled_Combined_Template.xlsx", "w") as gst_entry:
+                    write_template_xlsx(gst_entry, combined_gst_df, "GST_Combined_Template")
 
         zip_buffer.seek(0)
         st.download_button(